@@ -1,56 +1,320 @@
+import functools
+import math
 import matplotlib.pyplot as plt
 import numpy as np
 from numpy import nan, mean
 from numpy.random import randint
-from numpy.random import choice
 from collections import deque
 from matplotlib import animation
 from mpl_toolkits.mplot3d import Axes3D
 
+# Numba is optional. Without it the walks use the Cython kernels from
+# saw_kernel.pyx if they have been built (see setup.py), and otherwise fall 
+# back to the pure Python stepping methods on Saw2D/Saw3D.
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Log of the number of choices, indexed by the number of choices.
+_LOG_CHOICES = (0.0,) + tuple(math.log(k) for k in range(1, 7))
+
+def _uniforms(block=256, seed=None):
+    '''
+    Endless stream of uniform draws on [0,1), generated in blocks so the
+    Python walks don't call into numpy's random generator on every step.
+    With a seed the draws come from their own generator instead of numpy's
+    global random state.
+    '''
+    if seed is None:
+        random = np.random.random
+    else:
+        random = np.random.default_rng(seed).random
+    while True:
+        yield from random(block).tolist()
+
+@functools.lru_cache(maxsize=None)
+def _morton_tables(dim):
+    '''
+    Lookup tables for the Morton (Z-order) layout of a 3D grid of size dim.
+    Node (x,y,z) is at mx[x] | my[y] | mz[z], with the bits of x, y and z
+    interleaved so that neighbouring nodes are mostly close in memory.
+    
+    Bits are only interleaved while an axis still has bits at that level;
+    the leftover high bits of the longer axes are packed above them. The
+    largest index therefore stays below the product of the dimensions
+    rounded up to powers of two, even on very uneven lattices.
+    '''
+    # Bit positions in the index for each bit of x, y and z, lowest first.
+    bits = [(n-1).bit_length() for n in dim]
+    positions = ([], [], [])
+    pos = 0
+    for level in range(max(bits)):
+        for axis in (2, 1, 0):
+            if level < bits[axis]:
+                positions[axis].append(pos)
+                pos += 1
+    
+    def spread(n, axis_positions):
+        table = []
+        for i in range(n):
+            v = 0
+            for bit, p in enumerate(axis_positions):
+                v |= ((i >> bit) & 1) << p
+            table.append(v)
+        return tuple(table)
+    
+    return tuple(spread(dim[axis], positions[axis]) for axis in range(3))
+
+@functools.lru_cache(maxsize=None)
+def _morton_arrays(dim):
+    '''
+    _morton_tables as int64 arrays, for the compiled kernels.
+    '''
+    return tuple(np.array(t, dtype=np.int64) for t in _morton_tables(dim))
+
+# Rolling hash of the nodes on a walk, used by __hash__ and __eq__. Each node
+# is packed into 21 bits per coordinate, then sig = (sig*_HASH_MULT) ^ node,
+# kept to 64 bits.
+_HASH_MULT = 1000003
+_MASK64 = (1 << 64) - 1
+
+# joblib is optional as well. Without it the samples are drawn serially.
+try:
+    from joblib import Parallel, delayed, effective_n_jobs
+except ImportError:
+    Parallel = None
+
+
+#################################################
+# Compiled walk kernels (numba, or Cython as a fallback)
+#################################################
+if numba is not None:
+
+    @numba.njit(cache=True)
+    def _run2d(grid, nodes, total_length, mode, stop_prob, rng_state):
+        '''
+        Compiled stepping loop shared by Saw2D.run1/run2/run3.
+        
+            grid        -- uint8 occupancy grid, written in place.
+            nodes       -- (N,2) int32 buffer, filled with the visited nodes.
+            total_length -- maximum walk length (only used by mode 2).
+            mode        -- 1, 2 or 3, matching run1, run2 and run3.
+            stop_prob   -- probability of stopping at each step (mode 3).
+            rng_state   -- seed for numba's random generator.
+        
+        Returns the length of the walk, the log of the product of the
+        number of choices at each step, and the rolling hash of the nodes.
+        '''
+        np.random.seed(rng_state)
+        D0, D1 = grid.shape
+        options = np.empty(4, dtype=np.int8)
+        
+        cx = numba.int64(0)
+        cy = numba.int64(0)
+        length = numba.int64(0)
+        log_result = 0.0
+        sig = numba.uint64(0)
+        nodes[0, 0] = 0
+        nodes[0, 1] = 0
+        
+        while True:
+            if mode == 2 and length >= total_length:
+                break
+            if mode == 3:
+                U = np.random.random()
+            
+            n_opts = 0
+            if cy+1 < D1 and grid[cx, cy+1] == 0:
+                options[n_opts] = 0
+                n_opts += 1
+            if cy-1 >= 0 and grid[cx, cy-1] == 0:
+                options[n_opts] = 1
+                n_opts += 1
+            if cx-1 >= 0 and grid[cx-1, cy] == 0:
+                options[n_opts] = 2
+                n_opts += 1
+            if cx+1 < D0 and grid[cx+1, cy] == 0:
+                options[n_opts] = 3
+                n_opts += 1
+            
+            if n_opts == 0:
+                break
+            if mode == 3 and U < stop_prob:
+                break
+            
+            log_result += math.log(n_opts)
+            
+            # Probabilities are uniform, so pick an index directly.
+            direction = options[int(np.random.random()*n_opts)]
+            if direction == 0:
+                cy += 1
+            elif direction == 1:
+                cy -= 1
+            elif direction == 2:
+                cx -= 1
+            else:
+                cx += 1
+            
+            grid[cx, cy] = 1
+            length += 1
+            nodes[length, 0] = cx
+            nodes[length, 1] = cy
+            sig = (sig * numba.uint64(_HASH_MULT)) ^ \
+                  numba.uint64((cx << 21) | cy)
+        
+        return length, log_result, sig
+
+    @numba.njit(cache=True)
+    def _run3d(grid, mx, my, mz, nodes, total_length, mode, stop_prob, 
+               rng_state):
+        '''
+        Compiled stepping loop shared by Saw3D.run1/run2/run3. Same
+        arguments and return values as _run2d, with an (N,3) nodes buffer.
+        The grid is flat in Morton order, node (x,y,z) is at 
+        mx[x] | my[y] | mz[z].
+        '''
+        np.random.seed(rng_state)
+        D0, D1, D2 = len(mx), len(my), len(mz)
+        options = np.empty(6, dtype=np.int8)
+        
+        cx = numba.int64(0)
+        cy = numba.int64(0)
+        cz = numba.int64(0)
+        length = numba.int64(0)
+        log_result = 0.0
+        sig = numba.uint64(0)
+        nodes[0, 0] = 0
+        nodes[0, 1] = 0
+        nodes[0, 2] = 0
+        
+        while True:
+            if mode == 2 and length >= total_length:
+                break
+            if mode == 3:
+                U = np.random.random()
+            
+            n_opts = 0
+            if cy+1 < D1 and grid[mx[cx] | my[cy+1] | mz[cz]] == 0:
+                options[n_opts] = 0
+                n_opts += 1
+            if cy-1 >= 0 and grid[mx[cx] | my[cy-1] | mz[cz]] == 0:
+                options[n_opts] = 1
+                n_opts += 1
+            if cx-1 >= 0 and grid[mx[cx-1] | my[cy] | mz[cz]] == 0:
+                options[n_opts] = 2
+                n_opts += 1
+            if cx+1 < D0 and grid[mx[cx+1] | my[cy] | mz[cz]] == 0:
+                options[n_opts] = 3
+                n_opts += 1
+            if cz+1 < D2 and grid[mx[cx] | my[cy] | mz[cz+1]] == 0:
+                options[n_opts] = 4
+                n_opts += 1
+            if cz-1 >= 0 and grid[mx[cx] | my[cy] | mz[cz-1]] == 0:
+                options[n_opts] = 5
+                n_opts += 1
+            
+            if n_opts == 0:
+                break
+            if mode == 3 and U < stop_prob:
+                break
+            
+            log_result += math.log(n_opts)
+            
+            direction = options[int(np.random.random()*n_opts)]
+            if direction == 0:
+                cy += 1
+            elif direction == 1:
+                cy -= 1
+            elif direction == 2:
+                cx -= 1
+            elif direction == 3:
+                cx += 1
+            elif direction == 4:
+                cz += 1
+            else:
+                cz -= 1
+            
+            grid[mx[cx] | my[cy] | mz[cz]] = 1
+            length += 1
+            nodes[length, 0] = cx
+            nodes[length, 1] = cy
+            nodes[length, 2] = cz
+            sig = (sig * numba.uint64(_HASH_MULT)) ^ \
+                  numba.uint64((cx << 42) | (cy << 21) | cz)
+        
+        return length, log_result, sig
+
+else:
+    try:
+        from saw_kernel import run_saw_2d as _run2d
+        from saw_kernel import run_saw_3d as _run3d
+    except ImportError:
+        _run2d = None
+        _run3d = None
+
+
 class Saw():
     
     ###############################################
     # General methods for simulation and animation
     ###############################################
-    def __sample(M, dim=(10,10), space=2, method = 1):
+    def __sample(M, dim=(10,10), space=2, method = 1, n_jobs=-1):
         '''
         Used for calculating number of SAWs in a specified grid.
         
             dim -- the size of grid for the walk. Can be 2 or 3D. Just input
                     tuple. i.e. (10,10) for 10x10 2D lattice, or
                     (10,10,10) for 10x10x10 lattice in 3D.
+            n_jobs -- number of worker processes used by joblib. -1 uses
+                    all cores.
+        
+        Returns an array with the log of the estimate from each walk.
+        
+        The seed for each walk (and for run2 its maximum length) is drawn
+        upfront from a generator seeded from numpy's global random state,
+        so results are reproducible with np.random.seed regardless of how
+        the walks are spread over the workers.
+        '''
+        if (space, method) not in _WALKS or len(dim) != space:
+            raise ValueError("No {}D walk with method {} on a lattice of "
+                             "size {}".format(space, method, dim))
+        
+        if M == 0:
+            return np.empty(0)
+        
+        rng = np.random.default_rng(randint(2**31))
+        seeds = rng.integers(2**31, size=M)
+        lengths = None
+        if method == 2:
+            lengths = rng.integers(1, np.prod(dim), size=M)
+        
+        if Parallel is None:
+            return _walk_batch(dim, space, method, seeds, lengths)
+        
+        # One contiguous batch of seeds per worker, so each worker only
+        # allocates a single walk. Never more batches than walks.
+        n_batches = min(M, effective_n_jobs(n_jobs))
+        bounds = np.linspace(0, M, n_batches+1).astype(int)
+        logs = Parallel(n_jobs=n_jobs, backend='loky')(
+            delayed(_walk_batch)(dim, space, method, seeds[a:b], 
+                                 None if lengths is None else lengths[a:b])
+            for a, b in zip(bounds[:-1], bounds[1:]))
+        return np.concatenate(logs)
+
+    def log_mean_exp(logs):
         '''
-        SAWc = deque([])
-        
-        # Conditions to check for 2D
-        if space == 2 and method == 1:
-            for i in range(M):
-                SAWc.append( Saw.Saw2D(dim).run1() )
-            return SAWc
-        if space == 2 and method == 2:
-            for i in range(M):
-                SAWc.append( Saw.Saw2D(dim).run2() )
-            return SAWc
-        if space == 2 and method == 3:
-            for i in range(M):
-                SAWc.append( Saw.Saw2D(dim).run3() )
-            return SAWc
-        
-        # Conditions to check for 3D
-        if space == 3 and len(dim)==3 and method == 1:
-            for i in range(M):
-                SAWc.append( Saw.Saw3D(dim).run1() )
-            return SAWc       
-        if space == 3 and len(dim)==3 and method == 2:
-            for i in range(M):
-                SAWc.append( Saw.Saw3D(dim).run2() )
-            return SAWc        
-        if space == 3 and len(dim)==3 and method == 3:
-            for i in range(M):
-                SAWc.append( Saw.Saw3D(dim).run3() )
-            return SAWc
+        Log of the mean of exp(logs), computed in log space so that neither
+        the individual estimates nor the mean overflow. Use it to average
+        the log estimates from the walks, e.g. from batch_saw2d.
+        '''
+        logs = np.asarray(logs, dtype=np.float64)
+        if logs.size == 0:
+            raise ValueError("Need at least one sample to average")
+        top = logs.max()
+        return top + np.log(np.mean(np.exp(logs - top)))
 
-    def simulate2D(n, dim=(10,10), method = 1):
+    def simulate2D(n, dim=(10,10), method = 1, n_jobs=-1, log=False):
         '''
         
         Parameters
@@ -62,34 +326,134 @@ class Saw():
         method : int, optional
             The default is 1. Range is 1-3. Specifies the type of monte carlo
             involved in the simulation.
+        n_jobs : int, optional
+            The default is -1. Number of processes used to draw the samples,
+            -1 uses all cores.
+        log : bool, optional
+            The default is False. Return the log of the estimate, which
+            doesn't overflow on large lattices.
 
         Returns
         -------
         Large int
-            Returns the estimated number of SAWs in 2d.
+            Returns the estimated number of SAWs in 2d, or its log. Without
+            log=True this is inf once the estimate passes the float range.
+
+        '''
+        log_estimate = Saw.log_mean_exp(Saw.__sample(n, dim, method=method, 
+                                                     n_jobs=n_jobs))
+        return log_estimate if log else np.exp(log_estimate)
+    
+    def batch_saw2d(B, dim=(10,10), method=1, stop_prob=0.1):
+        '''
+        Run B independent 2D walks in lockstep with numpy. Each step checks
+        the four neighbours of every active walk at once, so the Python
+        overhead per step is shared by the whole batch.
+        
+        Parameters
+        ----------
+        B : int
+            Number of SAWs to generate.
+        dim : 2-Tuple, optional
+            The default is (10,10). This specifies a 10x10 lattice.
+        method : int, optional
+            The default is 1. Range is 1-3. Same stopping rules as run1, run2
+            and run3 on Saw2D.
+        stop_prob : float, optional
+            The default is 0.1. Probability of stopping at each step, only 
+            used by method 3.
+
+        Returns
+        -------
+        ndarray
+            The log of the estimate from each walk. Average them with 
+            Saw.log_mean_exp, which stays in log space so long walks don't
+            overflow.
 
         '''
-        return np.mean(Saw.__sample(n, dim, method=method))
+        if method not in (1, 2, 3) or len(dim) != 2:
+            raise ValueError("No 2D walk with method {} on a lattice of "
+                             "size {}".format(method, dim))
+        
+        D0, D1 = dim[0], dim[1]
+        DX = np.array(Saw.Saw2D._DX)
+        DY = np.array(Saw.Saw2D._DY)
+        
+        grid = np.zeros((B, D0, D1), dtype=np.uint8)
+        cx = np.zeros(B, dtype=np.int64)
+        cy = np.zeros(B, dtype=np.int64)
+        length = np.zeros(B, dtype=np.int64)
+        log_result = np.zeros(B, dtype=np.float64)
+        if method == 2:
+            total_length = np.random.randint(1, D0*D1, size=B)
+        
+        # Indices of the walks that are still going.
+        active = np.arange(B)
+        while len(active):
+            if method == 2:
+                active = active[length[active] < total_length[active]]
+            if method == 3:
+                active = active[np.random.random(len(active)) >= stop_prob]
+            
+            # Neighbours of each active walk, (len(active), 4), in the same
+            # order as Saw2D.move.
+            x = cx[active, None] + DX
+            y = cy[active, None] + DY
+            free = (x >= 0) & (x < D0) & (y >= 0) & (y < D1)
+            free &= grid[active[:, None], x.clip(0, D0-1), 
+                         y.clip(0, D1-1)] == 0
+            
+            n_opts = free.sum(axis=1)
+            trapped = n_opts == 0
+            if trapped.any():
+                active = active[~trapped]
+                x, y, free, n_opts = (x[~trapped], y[~trapped], 
+                                      free[~trapped], n_opts[~trapped])
+            
+            # Pick the k-th free direction of each walk uniformly.
+            k = (np.random.random(len(active))*n_opts).astype(np.int64)
+            direction = (free.cumsum(axis=1) <= k[:, None]).sum(axis=1)
+            rows = np.arange(len(active))
+            
+            cx[active] = x[rows, direction]
+            cy[active] = y[rows, direction]
+            grid[active, cx[active], cy[active]] = 1
+            log_result[active] += np.log(n_opts)
+            length[active] += 1
+        
+        return log_result
     
     def animate2D(n, dim=(10,10), method=1):
         
-        saws = deque([])
+        frames = deque([])
         for i in range(n):
             s = Saw.Saw2D(dim=dim)
             s.run2()
-            saws.append(s)
+            frames.append(s.coords())
             del s
-            
-        fig, ax = plt.subplots(111, projection='3d')
-        saw_plots = [saw.draw() for saw in saws]
-        my_anim = animation.ArtistAnimation(fig, 
-                                            saw_plots, 
-                                            interval = 500, 
-                                            blit=False, 
-                                            repeat_delay=2000)
+        
+        # One figure and one line for the whole animation. Each frame only
+        # swaps the data on the line.
+        fig, ax = plt.subplots()
+        line, = ax.plot([], [], '-o')
+        ax.set_xlim((0, dim[0]))
+        ax.set_xticks(range(0,dim[0]))
+        ax.set_ylim((0, dim[1]))
+        ax.set_yticks(range(0,dim[1]))
+        
+        def update(i):
+            line.set_data(*frames[i])
+            return line,
+        
+        my_anim = animation.FuncAnimation(fig, 
+                                          update, 
+                                          frames = n, 
+                                          interval = 500, 
+                                          blit=False, 
+                                          repeat_delay=2000)
         plt.show()
     
-    def simulate3D(n, dim=(10,10,10), method = 1):
+    def simulate3D(n, dim=(10,10,10), method = 1, n_jobs=-1, log=False):
         '''
         
         Parameters
@@ -101,30 +465,56 @@ class Saw():
         method : int, optional
             The default is 1. Range is 1-3. Specifies the type of monte carlo
             involved in the simulation.
+        n_jobs : int, optional
+            The default is -1. Number of processes used to draw the samples,
+            -1 uses all cores.
+        log : bool, optional
+            The default is False. Return the log of the estimate, which
+            doesn't overflow on large lattices.
 
         Returns
         -------
         Large int
-            Returns the estimated number of SAWs in 3d.
+            Returns the estimated number of SAWs in 3d, or its log. Without
+            log=True this is inf once the estimate passes the float range.
 
         '''
-        return np.mean(Saw.__sample(n, dim, space=3, method=method))
+        log_estimate = Saw.log_mean_exp(Saw.__sample(n, dim, space=3, 
+                                                     method=method, 
+                                                     n_jobs=n_jobs))
+        return log_estimate if log else np.exp(log_estimate)
     
     def animate3D(n, dim=(10,10,10), method=1):
-        saws = deque([])
+        
+        frames = deque([])
         for i in range(n):
             s = Saw.Saw3D(dim=dim)
             s.run2()
-            saws.append(s)
+            frames.append(s.coords())
             del s
-            
-        fig, ax = plt.subplots()
-        saw_plots = [saw.draw() for saw in saws]
-        my_anim = animation.ArtistAnimation(fig, 
-                                            saw_plots, 
-                                            interval = 500, 
-                                            blit=False, 
-                                            repeat_delay=2000)
+        
+        fig = plt.figure()
+        ax = fig.add_subplot(111, projection='3d')
+        line, = ax.plot([], [], [], '-o')
+        ax.set_xlim((0, dim[0]))
+        ax.set_xticks(range(0,dim[0]))
+        ax.set_ylim((0, dim[1]))
+        ax.set_yticks(range(0,dim[1]))
+        ax.set_zlim((0, dim[2]))
+        ax.set_zticks(range(0,dim[2]))
+        
+        def update(i):
+            x, y, z = frames[i]
+            line.set_data(x, y)
+            line.set_3d_properties(z)
+            return line,
+        
+        my_anim = animation.FuncAnimation(fig, 
+                                          update, 
+                                          frames = n, 
+                                          interval = 500, 
+                                          blit=False, 
+                                          repeat_delay=2000)
         plt.show()
     
     
@@ -144,34 +534,66 @@ class Saw():
                     runs until that length is achieved or the walk is trapped.
             run3 -- this method runs until there is a collision, or it will
                     terminate randomly with small probability.
+        
+        Each run returns the estimated number of walks, or its log with 
+        log=True. Pass seed to draw the steps from their own generator
+        rather than numpy's global random state.
+        
+        run_pivot samples walks of a fixed length with the pivot algorithm
+        instead.
         '''
         
+        __slots__ = ('dim', 'grid', 'start', 'cx', 'cy', 'end', 'log_result',
+                     'length', 'nodes', 'sig', 'total_points')
+        
+        # Steps in x and y for each direction (see move).
+        _DX = (0, 0, -1, 1)
+        _DY = (1, -1, 0, 0)
+        
+        # The lattice symmetries other than the identity, used by run_pivot:
+        # rotations by 90, 180 and 270 degrees, then reflections in the x
+        # axis, the y axis and the two diagonals.
+        _SYMMETRIES = np.array([[[ 0,-1], [ 1, 0]],
+                                [[-1, 0], [ 0,-1]],
+                                [[ 0, 1], [-1, 0]],
+                                [[ 1, 0], [ 0,-1]],
+                                [[-1, 0], [ 0, 1]],
+                                [[ 0, 1], [ 1, 0]],
+                                [[ 0,-1], [-1, 0]]], dtype=np.int32)
+        
         def __init__(self, dim = (10,10)):
             self.dim = dim
             
-            # False = not occupied, True = occupied.
-            self.grid = np.zeros((dim[0],dim[1]), dtype=bool)
+            # 0 = not occupied, 1 = occupied. Stored flat, node (x,y) is
+            # at x*dim[1]+y.
+            self.grid = np.zeros(dim[0]*dim[1], dtype=np.uint8)
             
             # Start at origin
             self.start = (0,0)
             
-            # Set sentinel
-            self.current = self.start
+            # Current position.
+            self.cx, self.cy = self.start
             
             # No established end point.
             self.end = np.nan
             
-            # Number of choices at each step. Max of dimension-1 steps.
-            self.num_choices = []
+            # Log of the product of the number of choices at each step.
+            self.log_result = 0.0
             
             # Length of the walk.
             self.length = 0
             
-            # Nodes
-            self.nodes = deque([self.start])
+            # Rolling hash of the nodes, updated on every move. The start
+            # node packs to 0.
+            self.sig = 0
             
             # Total points on the lattice.
             self.total_points = dim[0]*dim[1]
+            
+            # Nodes, preallocated for the longest possible walk. Only the
+            # first length+1 rows are part of the walk.
+            self.nodes = np.empty((self.total_points+1, 2), dtype=np.int32)
+            self.nodes[0] = self.start
     
         def __repr__(self):
             return "Self-avoiding walk of length {}".format(self.length)
@@ -180,33 +602,33 @@ class Saw():
             '''
             Walks are equal precisely if they pass through the same nodes.
             '''
-            return self.nodes == other.nodes
+            if self.sig != other.sig:
+                return False
+            return np.array_equal(self.nodes[:len(self)], 
+                                  other.nodes[:len(other)])
         
         def __hash__(self):
-            return hash(self.length)
+            return hash(self.sig)
         
         def __len__(self):
-            return len(self.nodes)
+            return self.length+1
         
-        def check_collision(self, node):
+        def reset(self):
             '''
-            Determine whether a given node on the lattice is part of the
-            SAW or boundary (if specified).
+            Clear the walk so that the object can be reused for another run
+            without reallocating the grid and nodes.
             '''
-            
-            # If the point of interest is outside of boundary, return false.
-            if node[0]<0 or node[1]<0:
-                return False
-            if node[0] >= self.dim[0] or node[1] >= self.dim[1]:
-                return False
-            
-            # Otherwise, find the value on the grid and determine if occupied.
-            return not self.grid[node[0]][node[1]]
-            
-            # if self.restricted == False:
-            #     return node not in self.nodes
-            # else:
-            #     return node not in self.nodes and node not in self.boundary
+            # Short walks only touch a few cells, so unmark just those
+            # rather than zeroing the whole lattice.
+            if len(self) < len(self.grid)//16:
+                nodes = self.nodes[:len(self)]
+                self.grid[nodes[:,0]*self.dim[1] + nodes[:,1]] = 0
+            else:
+                self.grid.fill(0)
+            self.cx, self.cy = self.start
+            self.log_result = 0.0
+            self.length = 0
+            self.sig = 0
         
         def find_movement_options(self):
             '''
@@ -214,14 +636,20 @@ class Saw():
             viable movement options.
             '''
             
+            cx, cy = self.cx, self.cy
+            D0, D1 = self.dim[0], self.dim[1]
+            g = self.grid
+            i = cx*D1 + cy
+            
+            # Same order as the directions in move.
             options = []
-            if self.check_collision((self.current[0], self.current[1]+1)):
+            if cy+1 < D1 and g[i+1] == 0:
                 options.append(0)
-            if self.check_collision((self.current[0], self.current[1]-1)):
+            if cy-1 >= 0 and g[i-1] == 0:
                 options.append(1)
-            if self.check_collision((self.current[0]-1, self.current[1])):
+            if cx-1 >= 0 and g[i-D1] == 0:
                 options.append(2)
-            if self.check_collision((self.current[0]+1, self.current[1])):
+            if cx+1 < D0 and g[i+D1] == 0:
                 options.append(3)
             
             if options == []:
@@ -232,7 +660,7 @@ class Saw():
         
         def move(self, direction):
             '''
-            Move in a given direction. 
+            Move in a given direction, given as an int.
             
             0 - Up
             1 - Down
@@ -240,37 +668,51 @@ class Saw():
             3 - Right
             '''
     
-            if direction == 0:
-                self.current = (self.current[0], self.current[1]+1)
-                self.grid[self.current[0]][self.current[1]] = True
-                self.nodes.append(self.current)
-            elif direction == 1:
-                self.current = (self.current[0], self.current[1]-1)
-                self.grid[self.current[0]][self.current[1]] = True
-                self.nodes.append(self.current)
-    
-            elif direction == 2:
-                self.current = (self.current[0]-1, self.current[1])
-                self.grid[self.current[0]][self.current[1]] = True
-                self.nodes.append(self.current)
-    
-            elif direction == 3:
-                self.current = (self.current[0]+1, self.current[1])
-                self.grid[self.current[0]][self.current[1]] = True
-                self.nodes.append(self.current)
-            else:
-                return False
-            
+            self.cx += self._DX[direction]
+            self.cy += self._DY[direction]
+            self.grid[self.cx*self.dim[1] + self.cy] = 1
             self.length = self.length+1
+            self.nodes[self.length] = (self.cx, self.cy)
+            self.sig = ((self.sig * _HASH_MULT) ^ 
+                        ((self.cx << 21) | self.cy)) & _MASK64
             return True
     
         
     
-        def run1(self, index = None):
+        def _run_kernel(self, mode, total_length=0, stop_prob=0.0, log=False,
+                        seed=None):
+            '''
+            Run the walk with the compiled kernel and copy the result back
+            onto this object. Only used when a compiled kernel is available.
+            '''
+            grid = self.grid.reshape(self.dim[0], self.dim[1])
+            if seed is None:
+                seed = randint(2**31)
+            length, log_result, sig = _run2d(grid, self.nodes, total_length, 
+                                        mode, stop_prob, seed)
+            
+            self.length = length
+            self.log_result = log_result
+            self.sig = int(sig)
+            self.cx, self.cy = self.nodes[length].tolist()
+            return self._estimate(log)
+    
+        def _estimate(self, log):
+            '''
+            The estimate from the last run, or its log if log is True. The
+            estimate itself overflows to inf on long walks.
+            '''
+            return self.log_result if log else np.exp(self.log_result)
+    
+        def run1(self, index = None, log=False, seed=None):
             '''
             run1: SAW keeps walking until out of options
             '''
             
+            if _run2d is not None:
+                return self._run_kernel(1, log=log, seed=seed)
+            
+            draws = _uniforms(seed=seed)
             while(True):
                 
                 options = self.find_movement_options()
@@ -278,88 +720,157 @@ class Saw():
                 if options == -1:
                     break
                 _LEN = len(options)
-                self.num_choices.append(_LEN)
-                probs = [1/_LEN]*_LEN
-                direction = choice(options, size=1, p = probs)
+                self.log_result += _LOG_CHOICES[_LEN]
+                direction = options[int(next(draws)*_LEN)]
                 self.move(direction)
                 
                             
             #self.nodes = tuple(self.nodes)
             
-            result = 1
-            for item in self.num_choices:
-                result = result*item
-            
-            return result
+            return self._estimate(log)
             #return self
         
         
-        def run2(self, index = None):
+        def run2(self, index = None, log=False, seed=None,
+                 total_length=None):
             '''
             run2: SAW starts by picking a maximum length, then walks until 
             either that length is achieved or it runs out of possible moves 
             (i.e. gets trapped).
             '''
             
-            # Pick a length at random. Either move until you can't move anymore
-            # or until you reach desired length.
-            total_length = np.random.randint(1,self.total_points)
+            # Pick a length at random unless given. Either move until you
+            # can't move anymore or until you reach desired length.
+            if total_length is None:
+                total_length = np.random.randint(1,self.total_points)
+            if _run2d is not None:
+                return self._run_kernel(2, total_length=total_length, log=log,
+                                        seed=seed)
+            
+            draws = _uniforms(seed=seed)
             while(self.length < total_length):
                 
                 options = self.find_movement_options()
                 if options == -1:
                     break
                 _LEN = len(options)
-                self.num_choices.append(_LEN)
-                probs = [1/_LEN]*_LEN
-                direction = choice(options, size=1, p = probs)
+                self.log_result += _LOG_CHOICES[_LEN]
+                direction = options[int(next(draws)*_LEN)]
                 self.move(direction)
                 
                             
             #self.nodes = tuple(self.nodes)
-            result = 1
-            for item in self.num_choices:
-                result = result*item
-            
-            return result
+            return self._estimate(log)
             #return self
         
-        def run3(self, stop_prob=0.1, index=None):
+        def run3(self, stop_prob=0.1, index=None, log=False, seed=None):
             '''
             run3: Run until collision or stop abruptly with small probability.
             '''
             
+            if _run2d is not None:
+                return self._run_kernel(3, stop_prob=stop_prob, log=log,
+                                        seed=seed)
+            
+            draws = _uniforms(seed=seed)
             while(True):
                 
-                U = np.random.uniform(0,1,1)
+                U = next(draws)
                 options = self.find_movement_options()
                 if options == -1 or U < stop_prob:
                     break
                 
-                self.num_choices.append(len(options))
-                probs = [1/len(options)]*len(options)
-                direction = choice(options, size=1, p = probs)
+                _LEN = len(options)
+                self.log_result += _LOG_CHOICES[_LEN]
+                direction = options[int(next(draws)*_LEN)]
                 self.move(direction)
                 
             #self.nodes = tuple(self.nodes)
             #del self.boundary
             
-            result = 1
-            for item in self.num_choices:
-                result = result*item
-            
-            return result
+            return self._estimate(log)
             #return self
+        
+        def run_pivot(self, n_pivots, length=None):
+            '''
+            run_pivot: Start from a straight walk along the longer axis and
+            apply n_pivots pivot moves. Each move picks a node on the walk and
+            one of the 7 lattice symmetries, applies it to the rest of the
+            walk around that node, and keeps the result if it stays on the 
+            lattice and doesn't hit the first part of the walk.
+            
+                length -- length of the walk. The default is 
+                        max(dim)-1, the longest straight walk that fits.
             
+            Returns the number of accepted pivots.
+            '''
+            
+            D0, D1 = self.dim[0], self.dim[1]
+            axis = 0 if D0 >= D1 else 1
+            if max(D0, D1) < 2:
+                raise ValueError("Lattice of size {} is too small for a walk "
+                                 "of length 1".format(self.dim))
+            if length is None:
+                length = max(D0, D1)-1
+            if length < 1 or length >= max(D0, D1):
+                raise ValueError("Need a straight walk of length 1 to {} on "
+                                 "this lattice, got {}".format(max(D0, D1)-1,
+                                                               length))
+            
+            nodes = self.nodes
+            nodes[:length+1, axis] = np.arange(length+1)
+            nodes[:length+1, 1-axis] = 0
+            self.grid[:] = 0
+            self.grid[nodes[:length+1, 0]*D1 + nodes[:length+1, 1]] = 1
+            
+            pivots = randint(length, size=n_pivots)
+            symmetries = randint(len(self._SYMMETRIES), size=n_pivots)
+            
+            accepted = 0
+            for k, m in zip(pivots.tolist(), symmetries.tolist()):
+                pivot = nodes[k]
+                old = nodes[k+1:length+1]
+                new = (old - pivot) @ self._SYMMETRIES[m].T + pivot
+                
+                if new.min() < 0 or new[:,0].max() >= D0 or \
+                new[:,1].max() >= D1:
+                    continue
+                
+                # Lift the old tail off the grid, then check the new one
+                # against the rest of the walk.
+                old_idx = old[:,0]*D1 + old[:,1]
+                new_idx = new[:,0]*D1 + new[:,1]
+                self.grid[old_idx] = 0
+                if self.grid[new_idx].any():
+                    self.grid[old_idx] = 1
+                    continue
+                
+                self.grid[new_idx] = 1
+                nodes[k+1:length+1] = new
+                accepted += 1
+            
+            self.length = length
+            self.cx, self.cy = nodes[length].tolist()
             
+            # Pivots rewrite the tail, so rebuild the hash from scratch.
+            self.sig = 0
+            for x, y in nodes[:length+1].tolist():
+                self.sig = ((self.sig * _HASH_MULT) ^ ((x << 21) | y)) & _MASK64
+            return accepted
+        
+        def coords(self):
+            '''
+            The x and y coordinates of the nodes on the walk, as views into
+            the nodes buffer.
+            '''
+            return self.nodes[:len(self), 0], self.nodes[:len(self), 1]
         
         def draw(self, show=False):
             '''
             Draw the SAW.
             '''
             
-            x = [node[0] for node in self.nodes]
-            y = [node[1] for node in self.nodes]
+            x, y = self.coords()
             
             p1, = plt.plot(x,y, '-o')
             p2 = plt.scatter(x,y,s=50)
@@ -386,32 +897,50 @@ class Saw():
         solution, but its easy.
         '''
         
+        __slots__ = ('dim', 'grid', 'morton', 'start', 'cx', 'cy', 'cz', 'end',
+                     'log_result', 'length', 'nodes', 'sig', 'total_points')
+        
+        # Steps in x, y and z for each direction (see move).
+        _DX = (0, 0, -1, 1, 0, 0)
+        _DY = (1, -1, 0, 0, 0, 0)
+        _DZ = (0, 0, 0, 0, 1, -1)
+        
         def __init__(self, dim = (10,10,10)):
             self.dim = dim
             
-            # False = not occupied, True = occupied.
-            self.grid = np.zeros((dim[0],dim[1],dim[2]), dtype=bool)
+            # 0 = not occupied, 1 = occupied. Stored flat in Morton order so
+            # that the neighbours of a node share cache lines: node (x,y,z)
+            # is at mx[x] | my[y] | mz[z], with self.morton = (mx, my, mz).
+            self.morton = _morton_tables(tuple(dim))
+            mx, my, mz = self.morton
+            self.grid = np.zeros((mx[-1] | my[-1] | mz[-1]) + 1, dtype=np.uint8)
             
             # Start at origin
             self.start = (0,0,0)
             
-            # Set sentinel
-            self.current = self.start
+            # Current position.
+            self.cx, self.cy, self.cz = self.start
             
             # No established end point.
             self.end = np.nan
             
-            # Number of choices at each step. Max of dimension-1 steps.
-            self.num_choices = []
+            # Log of the product of the number of choices at each step.
+            self.log_result = 0.0
             
             # Length of the walk.
             self.length = 0
             
-            # Nodes
-            self.nodes = deque([self.start])
+            # Rolling hash of the nodes, updated on every move. The start
+            # node packs to 0.
+            self.sig = 0
             
             # Total points on the lattice.
             self.total_points = dim[0]*dim[1]*dim[2]
+            
+            # Nodes, preallocated for the longest possible walk. Only the
+            # first length+1 rows are part of the walk.
+            self.nodes = np.empty((self.total_points+1, 3), dtype=np.int32)
+            self.nodes[0] = self.start
     
         def __repr__(self):
             return "Self-avoiding walk of length {}".format(self.length)
@@ -420,34 +949,34 @@ class Saw():
             '''
             Walks are equal precisely if they pass through the same nodes.
             '''
-            return self.nodes == other.nodes
+            if self.sig != other.sig:
+                return False
+            return np.array_equal(self.nodes[:len(self)], 
+                                  other.nodes[:len(other)])
         
         def __hash__(self):
-            return hash(self.length)
+            return hash(self.sig)
         
         def __len__(self):
-            return len(self.nodes)
+            return self.length+1
         
-        def check_collision(self, node):
+        def reset(self):
             '''
-            Determine whether a given node on the lattice is part of the
-            SAW or boundary (if specified).
+            Clear the walk so that the object can be reused for another run
+            without reallocating the grid and nodes.
             '''
-            
-            # If the point of interest is outside of boundary, return false.
-            if node[0]<0 or node[1]<0 or node[2]<0:
-                return False
-            if node[0] >= self.dim[0] or node[1] >= self.dim[1] or \
-            node[2] >= self.dim[2]:
-                return False
-            
-            # Otherwise, find the value on the grid and determine if occupied.
-            return not self.grid[node[0]][node[1]][node[2]]
-            
-            # if self.restricted == False:
-            #     return node not in self.nodes
-            # else:
-            #     return node not in self.nodes and node not in self.boundary
+            # Short walks only touch a few cells, so unmark just those
+            # rather than zeroing the whole lattice.
+            if len(self) < len(self.grid)//16:
+                nodes = self.nodes[:len(self)]
+                mx, my, mz = _morton_arrays(tuple(self.dim))
+                self.grid[mx[nodes[:,0]] | my[nodes[:,1]] | mz[nodes[:,2]]] = 0
+            else:
+                self.grid.fill(0)
+            self.cx, self.cy, self.cz = self.start
+            self.log_result = 0.0
+            self.length = 0
+            self.sig = 0
         
         def find_movement_options(self):
             '''
@@ -455,18 +984,25 @@ class Saw():
             viable movement options.
             '''
             
+            cx, cy, cz = self.cx, self.cy, self.cz
+            D0, D1, D2 = self.dim[0], self.dim[1], self.dim[2]
+            g = self.grid
+            mx, my, mz = self.morton
+            x, y, z = mx[cx], my[cy], mz[cz]
+            
+            # Same order as the directions in move.
             options = []
-            if self.check_collision((self.current[0], self.current[1]+1, self.current[2])):
+            if cy+1 < D1 and g[x | my[cy+1] | z] == 0:
                 options.append(0)
-            if self.check_collision((self.current[0], self.current[1]-1, self.current[2])):
+            if cy-1 >= 0 and g[x | my[cy-1] | z] == 0:
                 options.append(1)
-            if self.check_collision((self.current[0]-1, self.current[1], self.current[2])):
+            if cx-1 >= 0 and g[mx[cx-1] | y | z] == 0:
                 options.append(2)
-            if self.check_collision((self.current[0]+1, self.current[1], self.current[2])):
+            if cx+1 < D0 and g[mx[cx+1] | y | z] == 0:
                 options.append(3)
-            if self.check_collision((self.current[0], self.current[1], self.current[2]+1)):
+            if cz+1 < D2 and g[x | y | mz[cz+1]] == 0:
                 options.append(4)
-            if self.check_collision((self.current[0], self.current[1], self.current[2]-1)):
+            if cz-1 >= 0 and g[x | y | mz[cz-1]] == 0:
                 options.append(5)
             
             if options == []:
@@ -477,7 +1013,7 @@ class Saw():
         
         def move(self, direction):
             '''
-            Move in a given direction. 
+            Move in a given direction, given as an int.
             
             0 - Up y
             1 - Down y
@@ -487,48 +1023,53 @@ class Saw():
             5 - Elevation- z
             '''
     
-            if direction == 0:
-                self.current = (self.current[0], self.current[1]+1, self.current[2])
-                self.grid[self.current[0]][self.current[1]][self.current[2]] = True
-                self.nodes.append(self.current)
-                
-            elif direction == 1:
-                self.current = (self.current[0], self.current[1]-1, self.current[2])
-                self.grid[self.current[0]][self.current[1]][self.current[2]] = True 
-                self.nodes.append(self.current)
-    
-            elif direction == 2:
-                self.current = (self.current[0]-1, self.current[1], self.current[2])
-                self.grid[self.current[0]][self.current[1]][self.current[2]] = True
-                self.nodes.append(self.current)
-    
-            elif direction == 3:
-                self.current = (self.current[0]+1, self.current[1], self.current[2])
-                self.grid[self.current[0]][self.current[1]][self.current[2]] = True
-                self.nodes.append(self.current)
-                
-            elif direction == 4:
-                self.current = (self.current[0], self.current[1], self.current[2]+1)
-                self.grid[self.current[0]][self.current[1]][self.current[2]] = True
-                self.nodes.append(self.current)
-                
-            elif direction == 5:
-                self.current = (self.current[0], self.current[1], self.current[2]-1)
-                self.grid[self.current[0]][self.current[1]][self.current[2]] = True
-                self.nodes.append(self.current)
-            else:
-                return False
-            
+            self.cx += self._DX[direction]
+            self.cy += self._DY[direction]
+            self.cz += self._DZ[direction]
+            mx, my, mz = self.morton
+            self.grid[mx[self.cx] | my[self.cy] | mz[self.cz]] = 1
             self.length = self.length+1
+            self.nodes[self.length] = (self.cx, self.cy, self.cz)
+            self.sig = ((self.sig * _HASH_MULT) ^ 
+                        ((self.cx << 42) | (self.cy << 21) | self.cz)) & _MASK64
             return True
     
         
     
-        def run1(self, index = None):
+        def _run_kernel(self, mode, total_length=0, stop_prob=0.0, log=False,
+                        seed=None):
+            '''
+            Run the walk with the compiled kernel and copy the result back
+            onto this object. Only used when a compiled kernel is available.
+            '''
+            if seed is None:
+                seed = randint(2**31)
+            mx, my, mz = _morton_arrays(tuple(self.dim))
+            length, log_result, sig = _run3d(self.grid, mx, my, mz, self.nodes,
+                                        total_length, mode, stop_prob, seed)
+            
+            self.length = length
+            self.log_result = log_result
+            self.sig = int(sig)
+            self.cx, self.cy, self.cz = self.nodes[length].tolist()
+            return self._estimate(log)
+    
+        def _estimate(self, log):
+            '''
+            The estimate from the last run, or its log if log is True. The
+            estimate itself overflows to inf on long walks.
+            '''
+            return self.log_result if log else np.exp(self.log_result)
+    
+        def run1(self, index = None, log=False, seed=None):
             '''
             run1: SAW keeps walking until out of options
             '''
             
+            if _run3d is not None:
+                return self._run_kernel(1, log=log, seed=seed)
+            
+            draws = _uniforms(seed=seed)
             while(True):
                 
                 options = self.find_movement_options()
@@ -536,89 +1077,93 @@ class Saw():
                 if options == -1:
                     break
                 _LEN = len(options)
-                self.num_choices.append(_LEN)
-                probs = [1/_LEN]*_LEN
-                direction = choice(options, size=1, p = probs)
+                self.log_result += _LOG_CHOICES[_LEN]
+                direction = options[int(next(draws)*_LEN)]
                 self.move(direction)
                 
                             
             #self.nodes = tuple(self.nodes)
             
-            result = 1
-            for item in self.num_choices:
-                result = result*item
-            
-            return result
+            return self._estimate(log)
             #return self
         
         
-        def run2(self, index = None):
+        def run2(self, index = None, log=False, seed=None,
+                 total_length=None):
             '''
             run2: SAW starts by picking a maximum length, then walks until 
             either that length is achieved or it runs out of possible moves 
             (i.e. gets trapped).
             '''
             
-            # Pick a length at random. Either move until you can't move anymore
-            # or until you reach desired length.
-            total_length = np.random.randint(1,self.total_points)
+            # Pick a length at random unless given. Either move until you
+            # can't move anymore or until you reach desired length.
+            if total_length is None:
+                total_length = np.random.randint(1,self.total_points)
+            if _run3d is not None:
+                return self._run_kernel(2, total_length=total_length, log=log,
+                                        seed=seed)
+            
+            draws = _uniforms(seed=seed)
             while(self.length < total_length):
                 
                 options = self.find_movement_options()
                 if options == -1:
                     break
                 _LEN = len(options)
-                self.num_choices.append(_LEN)
-                probs = [1/_LEN]*_LEN
-                direction = choice(options, size=1, p = probs)
+                self.log_result += _LOG_CHOICES[_LEN]
+                direction = options[int(next(draws)*_LEN)]
                 self.move(direction)
                 
                             
             #self.nodes = tuple(self.nodes)
-            result = 1
-            for item in self.num_choices:
-                result = result*item
-            
-            return result
+            return self._estimate(log)
             #return self
         
-        def run3(self, stop_prob=0.1, index=None):
+        def run3(self, stop_prob=0.1, index=None, log=False, seed=None):
             '''
             run3: Run until collision or stop abruptly with small probability.
             '''
             
+            if _run3d is not None:
+                return self._run_kernel(3, stop_prob=stop_prob, log=log,
+                                        seed=seed)
+            
+            draws = _uniforms(seed=seed)
             while(True):
                 
-                U = np.random.uniform(0,1,1)
+                U = next(draws)
                 options = self.find_movement_options()
                 if options == -1 or U < stop_prob:
                     break
                 
-                self.num_choices.append(len(options))
-                probs = [1/len(options)]*len(options)
-                direction = choice(options, size=1, p = probs)
+                _LEN = len(options)
+                self.log_result += _LOG_CHOICES[_LEN]
+                direction = options[int(next(draws)*_LEN)]
                 self.move(direction)
                 
             #self.nodes = tuple(self.nodes)
             #del self.boundary
             
-            result = 1
-            for item in self.num_choices:
-                result = result*item
-            
-            return result
+            return self._estimate(log)
             #return self
             
             
         
+        def coords(self):
+            '''
+            The x, y and z coordinates of the nodes on the walk, as views
+            into the nodes buffer.
+            '''
+            return (self.nodes[:len(self), 0], self.nodes[:len(self), 1],
+                    self.nodes[:len(self), 2])
+        
         def draw(self, show=True):
             '''
             Draw the SAW.
             '''
             
-            x = [node[0] for node in self.nodes]
-            y = [node[1] for node in self.nodes]
-            z = [node[2] for node in self.nodes]
+            x, y, z = self.coords()
 
             fig = plt.figure()
             ax = fig.add_subplot(111, projection='3d')
@@ -640,5 +1185,37 @@ class Saw():
                 plt.show()
             
             return [p1, p2]
-        
-            
\ No newline at end of file
+
+
+###############################################
+# Single walks for Saw.__sample
+###############################################
+# Keyed on (space, method).
+_WALKS = {
+    (2,1): (Saw.Saw2D, Saw.Saw2D.run1),
+    (2,2): (Saw.Saw2D, Saw.Saw2D.run2),
+    (2,3): (Saw.Saw2D, Saw.Saw2D.run3),
+    (3,1): (Saw.Saw3D, Saw.Saw3D.run1),
+    (3,2): (Saw.Saw3D, Saw.Saw3D.run2),
+    (3,3): (Saw.Saw3D, Saw.Saw3D.run3),
+}
+
+def _walk_batch(dim, space, method, seeds, lengths=None):
+    '''
+    Run one walk per seed in seeds and return an array with the log of each
+    estimate. For run2, lengths gives the maximum length of each walk. A
+    single walk object is reset and reused for the whole batch. Kept at
+    module level so joblib can send it to worker processes.
+    '''
+    walk_class, run = _WALKS[(space, method)]
+    walk = walk_class(dim)
+    
+    out = np.empty(len(seeds), dtype=np.float64)
+    for i, seed in enumerate(seeds.tolist()):
+        walk.reset()
+        if lengths is None:
+            out[i] = run(walk, log=True, seed=seed)
+        else:
+            out[i] = run(walk, log=True, seed=seed, 
+                         total_length=int(lengths[i]))
+    return out
@@ -0,0 +1,205 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+'''
+Cython versions of the walk kernels in Saw.py, for use when numba is not
+available. Build in place with:
+
+    python setup.py build_ext --inplace
+
+run_saw_2d/run_saw_3d take the same arguments and return the same values as
+_run2d/_run3d in Saw.py, and run the walk with the GIL released.
+'''
+
+from libc.math cimport log
+from libc.stdint cimport int64_t, uint64_t
+
+
+cdef inline uint64_t _splitmix64(uint64_t *state) nogil:
+    '''
+    Advance a splitmix64 generator and return the next 64 random bits.
+    '''
+    state[0] += 0x9E3779B97F4A7C15ULL
+    cdef uint64_t z = state[0]
+    z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL
+    z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL
+    return z ^ (z >> 31)
+
+cdef inline double _uniform(uint64_t *state) nogil:
+    '''
+    Uniform draw on [0,1) from the top 53 bits.
+    '''
+    return (_splitmix64(state) >> 11) * (1.0/9007199254740992.0)
+
+
+cdef long _walk_2d(unsigned char[:, ::1] grid, int[:, ::1] nodes,
+                   long total_length, int mode, double stop_prob,
+                   uint64_t seed, double *log_result, uint64_t *sig) nogil:
+    cdef long D0 = grid.shape[0]
+    cdef long D1 = grid.shape[1]
+    cdef long cx = 0, cy = 0, length = 0
+    cdef int options[4]
+    cdef int n_opts, direction
+    cdef double U = 1.0
+    cdef uint64_t state = seed
+
+    log_result[0] = 0.0
+    sig[0] = 0
+    nodes[0, 0] = 0
+    nodes[0, 1] = 0
+
+    while True:
+        if mode == 2 and length >= total_length:
+            break
+        if mode == 3:
+            U = _uniform(&state)
+
+        n_opts = 0
+        if cy+1 < D1 and grid[cx, cy+1] == 0:
+            options[n_opts] = 0
+            n_opts += 1
+        if cy-1 >= 0 and grid[cx, cy-1] == 0:
+            options[n_opts] = 1
+            n_opts += 1
+        if cx-1 >= 0 and grid[cx-1, cy] == 0:
+            options[n_opts] = 2
+            n_opts += 1
+        if cx+1 < D0 and grid[cx+1, cy] == 0:
+            options[n_opts] = 3
+            n_opts += 1
+
+        if n_opts == 0:
+            break
+        if mode == 3 and U < stop_prob:
+            break
+
+        log_result[0] += log(n_opts)
+
+        direction = options[<int>(_uniform(&state)*n_opts)]
+        if direction == 0:
+            cy += 1
+        elif direction == 1:
+            cy -= 1
+        elif direction == 2:
+            cx -= 1
+        else:
+            cx += 1
+
+        grid[cx, cy] = 1
+        length += 1
+        nodes[length, 0] = cx
+        nodes[length, 1] = cy
+        sig[0] = (sig[0] * 1000003ULL) ^ ((<uint64_t>cx << 21) | <uint64_t>cy)
+
+    return length
+
+
+cdef long _walk_3d(unsigned char[::1] grid, int64_t[::1] mx, int64_t[::1] my,
+                   int64_t[::1] mz, int[:, ::1] nodes, long total_length,
+                   int mode, double stop_prob, uint64_t seed,
+                   double *log_result, uint64_t *sig) nogil:
+    cdef long D0 = mx.shape[0]
+    cdef long D1 = my.shape[0]
+    cdef long D2 = mz.shape[0]
+    cdef long cx = 0, cy = 0, cz = 0, length = 0
+    cdef int options[6]
+    cdef int n_opts, direction
+    cdef double U = 1.0
+    cdef uint64_t state = seed
+
+    log_result[0] = 0.0
+    sig[0] = 0
+    nodes[0, 0] = 0
+    nodes[0, 1] = 0
+    nodes[0, 2] = 0
+
+    while True:
+        if mode == 2 and length >= total_length:
+            break
+        if mode == 3:
+            U = _uniform(&state)
+
+        n_opts = 0
+        if cy+1 < D1 and grid[mx[cx] | my[cy+1] | mz[cz]] == 0:
+            options[n_opts] = 0
+            n_opts += 1
+        if cy-1 >= 0 and grid[mx[cx] | my[cy-1] | mz[cz]] == 0:
+            options[n_opts] = 1
+            n_opts += 1
+        if cx-1 >= 0 and grid[mx[cx-1] | my[cy] | mz[cz]] == 0:
+            options[n_opts] = 2
+            n_opts += 1
+        if cx+1 < D0 and grid[mx[cx+1] | my[cy] | mz[cz]] == 0:
+            options[n_opts] = 3
+            n_opts += 1
+        if cz+1 < D2 and grid[mx[cx] | my[cy] | mz[cz+1]] == 0:
+            options[n_opts] = 4
+            n_opts += 1
+        if cz-1 >= 0 and grid[mx[cx] | my[cy] | mz[cz-1]] == 0:
+            options[n_opts] = 5
+            n_opts += 1
+
+        if n_opts == 0:
+            break
+        if mode == 3 and U < stop_prob:
+            break
+
+        log_result[0] += log(n_opts)
+
+        direction = options[<int>(_uniform(&state)*n_opts)]
+        if direction == 0:
+            cy += 1
+        elif direction == 1:
+            cy -= 1
+        elif direction == 2:
+            cx -= 1
+        elif direction == 3:
+            cx += 1
+        elif direction == 4:
+            cz += 1
+        else:
+            cz -= 1
+
+        grid[mx[cx] | my[cy] | mz[cz]] = 1
+        length += 1
+        nodes[length, 0] = cx
+        nodes[length, 1] = cy
+        nodes[length, 2] = cz
+        sig[0] = (sig[0] * 1000003ULL) ^ ((<uint64_t>cx << 42) |
+                                          (<uint64_t>cy << 21) | <uint64_t>cz)
+
+    return length
+
+
+def run_saw_2d(unsigned char[:, ::1] grid, int[:, ::1] nodes,
+               long total_length, int mode, double stop_prob, uint64_t seed):
+    '''
+    Walk on a 2D uint8 grid, filling the (N,2) int32 nodes buffer.
+
+    Returns the length of the walk, the log of the product of the number
+    of choices at each step, and the rolling hash of the nodes.
+    '''
+    cdef double log_result
+    cdef uint64_t sig
+    cdef long length
+    with nogil:
+        length = _walk_2d(grid, nodes, total_length, mode, stop_prob, seed,
+                          &log_result, &sig)
+    return length, log_result, sig
+
+
+def run_saw_3d(unsigned char[::1] grid, int64_t[::1] mx, int64_t[::1] my,
+               int64_t[::1] mz, int[:, ::1] nodes, long total_length,
+               int mode, double stop_prob, uint64_t seed):
+    '''
+    Walk on a flat uint8 grid in Morton order, where node (x,y,z) is at
+    mx[x] | my[y] | mz[z], filling the (N,3) int32 nodes buffer.
+
+    Returns the length of the walk, the log of the product of the number
+    of choices at each step, and the rolling hash of the nodes.
+    '''
+    cdef double log_result
+    cdef uint64_t sig
+    cdef long length
+    with nogil:
+        length = _walk_3d(grid, mx, my, mz, nodes, total_length, mode,
+                          stop_prob, seed, &log_result, &sig)
+    return length, log_result, sig
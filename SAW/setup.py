@@ -0,0 +1,13 @@
+'''
+Builds the optional Cython walk kernels used by Saw.py when numba is not
+installed:
+
+    python setup.py build_ext --inplace
+'''
+from setuptools import setup
+from Cython.Build import cythonize
+
+setup(
+    name='saw_kernel',
+    ext_modules=cythonize('saw_kernel.pyx'),
+)